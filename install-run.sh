@@ -2,9 +2,10 @@
 set -e
 echo "✅ Starting Termux One-Shot Installer ..."
 pkg update -y && pkg upgrade -y
-pkg install -y python git clang openssl redis postgresql python-numpy python-pandas curl
+pkg install -y python git clang openssl redis postgresql curl
 pip install --upgrade pip
-pip install flask pandas aiohttp beautifulsoup4 lxml fake-useragent langdetect scikit-learn openpyxl tenacity
+pip install flask polars aiohttp selectolax fake-useragent langdetect xlsxwriter orjson gunicorn waitress tenacity
+pip install uvloop || true
 mkdir -p ~/pricebot && cd ~/pricebot
 curl -o robot.py https://raw.githubusercontent.com/YOUR_USERNAME/price-robot-termux/main/robot.py || \
 cat > robot.py << 'EOF'
@@ -3,10 +3,17 @@
 """
 PriceRobot – Termux All-in-One
 """
-import os, sys, json, time, asyncio, logging, pathlib, hashlib, queue, threading
+import os, re, sys, json, time, asyncio, logging, pathlib, hashlib, queue, threading, collections, urllib.parse
 from datetime import datetime
 from typing import List, Dict, Optional
-from flask import Flask, request, jsonify, render_template_string, send_file, redirect, url_for, flash
+import jinja2
+from flask import Flask, Response, request, jsonify, render_template, send_file, redirect, url_for, flash
+
+try:  # libuv event loop – noticeably faster for the aiohttp fan-out, optional on Termux
+    import uvloop
+    uvloop.install()
+except ImportError:
+    pass
 
 # ---------------- Logger ----------------
 logging.basicConfig(level=logging.INFO, format="%(asctime)s | %(levelname)-8s | %(message)s")
@@ -18,58 +25,109 @@ BASE_DIR.mkdir(exist_ok=True)
 DEFAULT_TERMS = ["گوشی سامسونگ A54", "لپ تاپ لنوو ThinkPad", "ساعت هوشمند اپل سری ۹"]
 
 # ---------------- Price Extractor ----------------
+_DIGIT_TRANS = str.maketrans("۰۱۲۳۴۵۶۷۸۹٠١٢٣٤٥٦٧٨٩", "01234567890123456789")
+_PRICE_RE = re.compile(
+    r"(?P<toman>[\d,]+)\s?تومان|(?P<rial>[\d,]+)\s?ریال|\$(?P<dollar>[\d,]+)|(?P<dirham>[\d,]+)\s?درهم",
+    re.IGNORECASE,
+)
+_RATES = {"toman": 1, "rial": 0.1, "dollar": 55_000, "dirham": 15_000}
+
 class PriceExtractor:
+    def __init__(self):
+        # Search pages repeat identical price strings across cards; remember
+        # both hits and misses so duplicates cost one dict lookup.
+        self._cache: Dict[str, Optional[Dict]] = {}
+
     def extract(self, text: str) -> Optional[Dict]:
-        import re
-        text = text.translate(str.maketrans("۰۱۲۳۴۵۶۷۸۹٠١٢٣٤٥٦٧٨٩", "01234567890123456789"))
-        patterns = {"toman": [r"([\d,]+)\s?تومان"], "rial": [r"([\d,]+)\s?ریال"], "dollar": [r"\$([\d,]+)"], "dirham": [r"([\d,]+)\s?درهم"]}
-        rates = {"rial": 0.1, "dollar": 55_000, "dirham": 15_000, "toman": 1}
-        for curr, pats in patterns.items():
-            for pat in pats:
-                m = re.search(pat, text, re.IGNORECASE)
-                if m:
-                    num = float(m.group(1).replace(",", ""))
-                    return {"original": num, "currency": curr, "toman": num * rates[curr]}
-        return None
+        if text in self._cache:
+            return self._cache[text]
+        result = None
+        m = _PRICE_RE.search(text.translate(_DIGIT_TRANS))
+        if m:
+            for curr, val in m.groupdict().items():
+                if val is not None:
+                    num = float(val.replace(",", ""))
+                    result = {"original": num, "currency": curr, "toman": num * _RATES[curr]}
+                    break
+        if len(self._cache) >= 4096:
+            self._cache.clear()
+        self._cache[text] = result
+        return result
 
 # ---------------- Async Scraper ----------------
 class AsyncScraper:
-    async def init(self): pass
-    async def close(self): pass
-    async def scrape(self, url: str) -> str:
+    def __init__(self):
+        self._session = None
+        self._host_sems: Dict[str, asyncio.Semaphore] = collections.defaultdict(lambda: asyncio.Semaphore(3))
+
+    async def init(self):
         import aiohttp
-        async with aiohttp.ClientSession() as sess:
-            async with sess.get(url, headers={"User-Agent": "Mozilla/5.0"}, timeout=15) as resp:
-                return await resp.text()
+        if self._session and not self._session.closed:
+            return
+        self._session = aiohttp.ClientSession(
+            headers={"User-Agent": "Mozilla/5.0"},
+            connector=aiohttp.TCPConnector(limit=100, limit_per_host=10, ttl_dns_cache=300),
+            timeout=aiohttp.ClientTimeout(total=15),
+        )
+
+    async def close(self):
+        if self._session:
+            await self._session.close()
+            self._session = None
+
+    async def scrape(self, url: str) -> bytes:
+        import aiohttp
+        # Only the first few product cards are used, so a bounded read of the
+        # body is enough and avoids buffering/decoding multi-MB result pages.
+        # At most 3 in-flight requests per host, with one backoff retry on
+        # transient errors, so the term fan-out does not trip rate limits.
+        host = urllib.parse.urlsplit(url).hostname
+        async with self._host_sems[host]:
+            for attempt in range(2):
+                try:
+                    async with self._session.get(url) as resp:
+                        return await resp.content.read(512 * 1024)
+                except aiohttp.ClientError:
+                    if attempt:
+                        raise
+                    await asyncio.sleep(0.3 * 2 ** attempt)
 
 # ---------------- Analyzer ----------------
 class Analyzer:
     def run(self, products: List[Dict]) -> Dict:
-        import pandas as pd
-        df = pd.DataFrame(products)
-        if df.empty: return {"total": 0}
-        df["price"] = pd.to_numeric(df["price"], errors="coerce")
-        df = df.dropna(subset=["price"])
+        prices = [float(p["price"]) for p in products if isinstance(p.get("price"), (int, float))]
+        if not prices:
+            return {"total": 0}
+        prices.sort()
+        n = len(prices)
+        median = prices[n // 2] if n % 2 else (prices[n // 2 - 1] + prices[n // 2]) / 2
         return {
-            "total": len(df), "min": df["price"].min(),
-            "max": df["price"].max(), "mean": df["price"].mean(), "median": df["price"].median(),
+            "total": n, "min": prices[0],
+            "max": prices[-1], "mean": sum(prices) / n, "median": median,
         }
 
 # ---------------- Notifier ----------------
 class Notifier:
     def save_excel(self, report: Dict) -> pathlib.Path:
-        import pandas as pd
-        products = []
+        import polars as pl
+        cols = {"Search Term": [], "Name": [], "Price (Toman)": [], "Website": [], "Country": [], "URL": []}
         for r in report["results"]:
             for p in r["products"]:
-                products.append({"Search Term": r["search_term"], "Name": p["name"], "Price (Toman)": p["price"], "Website": p["website"], "Country": p["country"], "URL": p["url"]})
-        df = pd.DataFrame(products)
-        path = BASE_DIR / f"price_report_{pd.Timestamp.now().strftime('%Y%m%d_%H%M%S')}.xlsx"
-        df.to_excel(path, index=False)
+                cols["Search Term"].append(r["search_term"])
+                cols["Name"].append(p["name"])
+                cols["Price (Toman)"].append(p["price"])
+                cols["Website"].append(p["website"])
+                cols["Country"].append(p["country"])
+                cols["URL"].append(p["url"])
+        df = pl.DataFrame(cols)
+        path = BASE_DIR / f"price_report_{datetime.now().strftime('%Y%m%d_%H%M%S')}.xlsx"
+        df.write_excel(path)
         log.info("Excel saved: %s", path)
         return path
 
 # ---------------- Web Robot ----------------
+_CARD_SEL = ".product, .item, [data-testid='product-card']"
+
 class WebRobot:
     def __init__(self):
         self.scraper = AsyncScraper()
@@ -79,39 +137,46 @@ class WebRobot:
 
     async def search(self, terms: List[str], task_id: str):
         await self.scraper.init()
-        all_results = []
+        all_tasks = []
         for term in terms:
             log.info("Web search: %s", term)
+            q = urllib.parse.quote_plus(term)
             urls = [
-                f"https://torob.ir/search/?query={term.replace(' ', '%20')}",
-                f"https://divar.ir/s/tehran?q={term.replace(' ', '%20')}",
-                f"https://www.amazon.com/s?k={term.replace(' ', '+')}",
+                (f"https://torob.ir/search/?query={q}", "torob.ir"),
+                (f"https://divar.ir/s/tehran?q={q}", "divar.ir"),
+                (f"https://www.amazon.com/s?k={q}", "amazon.com"),
             ]
-            tasks = [self._fetch_one(url, term) for url in urls]
-            results = await asyncio.gather(*tasks)
-            products = [p for res in results for p in res]
+            for url, host in urls:
+                all_tasks.append((term, asyncio.create_task(self._fetch_one(url, host, term))))
+        await asyncio.gather(*(task for _, task in all_tasks))
+        by_term: Dict[str, List[Dict]] = {term: [] for term in terms}
+        for term, task in all_tasks:
+            by_term[term].extend(task.result())
+        all_results = []
+        for term in terms:
+            products = by_term[term]
             analysis = self.analyzer.run(products)
             all_results.append({"search_term": term, "products": products, "analysis": analysis})
-        await self.scraper.close()
         report = {"summary": {"total": sum(len(r["products"]) for r in all_results)}, "results": all_results}
-        excel_path = self.notifier.save_excel(report)
+        report["excel_path"] = str(self.notifier.save_excel(report))
         log.info("Web task %s finished", task_id)
-        return excel_path
+        return report
 
-    async def _fetch_one(self, url: str, term: str) -> List[Dict]:
-        from bs4 import BeautifulSoup
+    async def _fetch_one(self, url: str, host: str, term: str) -> List[Dict]:
+        from selectolax.lexbor import LexborHTMLParser
         try:
             html = await self.scraper.scrape(url)
-            soup = BeautifulSoup(html, "lxml")
+            tree = LexborHTMLParser(html)
             products = []
-            for card in soup.select(".product, .item, [data-testid='product-card']")[:5]:
-                name = card.get_text(" ", strip=True)[:100]
-                price_data = self.extractor.extract(card.get_text(" ", strip=True))
+            for node in tree.css(_CARD_SEL)[:5]:
+                txt = node.text(separator=" ", strip=True)
+                name = txt[:100]
+                price_data = self.extractor.extract(txt)
                 if price_data:
                     products.append({
                         "name": name, "price": price_data["toman"],
                         "original_currency": price_data["currency"],
-                        "website": url.split("/")[2], "country": "Iran", "url": url,
+                        "website": host, "country": "Iran", "url": url,
                     })
             return products
         except Exception as e:
@@ -122,17 +187,84 @@ class WebRobot:
 # ---------------- Flask App ----------------
 app = Flask(__name__)
 app.secret_key = "price_robot_secret_123"
-results_store: Dict[str, Dict] = {}
 
+try:  # C JSON encoder for the /api/* responses, optional like uvloop
+    import orjson
+    from flask.json.provider import DefaultJSONProvider
+
+    class OrjsonProvider(DefaultJSONProvider):
+        def dumps(self, obj, **kwargs):
+            return orjson.dumps(obj, default=self.default).decode()
+
+        def loads(self, s, **kwargs):
+            return orjson.loads(s)
+
+    app.json = OrjsonProvider(app)
+except ImportError:
+    pass
+
+# Task state is written from the event-loop thread and read from Flask
+# request threads, so every access goes through the lock; the store is
+# bounded and evicts the oldest finished tasks instead of growing forever.
+results_store: "collections.OrderedDict[str, Dict]" = collections.OrderedDict()
+task_events: Dict[str, threading.Event] = {}
+_STORE_LOCK = threading.RLock()
+
+
+def store_put(task_id: str, value: Dict):
+    with _STORE_LOCK:
+        results_store[task_id] = value
+        results_store.move_to_end(task_id)
+        while len(results_store) > 128:
+            old_id, _ = results_store.popitem(last=False)
+            task_events.pop(old_id, None)
 
-def run_in_thread(terms: List[str], task_id: str):
-    robot = WebRobot()
+
+def store_get(task_id: str) -> Optional[Dict]:
+    with _STORE_LOCK:
+        return results_store.get(task_id)
+
+# One background event loop and one WebRobot shared by all tasks, so the
+# aiohttp session, connector pool and DNS cache survive across searches.
+# Both the loop object and its thread are created lazily on first use
+# rather than at import: under gunicorn the module is imported in the
+# master and the worker is forked from it — threads do not survive fork,
+# and a uvloop created pre-fork must not be run in the child.
+_LOOP: Optional[asyncio.AbstractEventLoop] = None
+_LOOP_LOCK = threading.Lock()
+_LOOP_THREAD: Optional[threading.Thread] = None
+_ROBOT = WebRobot()
+
+
+def _ensure_loop() -> asyncio.AbstractEventLoop:
+    global _LOOP, _LOOP_THREAD
+    with _LOOP_LOCK:
+        if _LOOP is None or _LOOP_THREAD is None or not _LOOP_THREAD.is_alive():
+            _LOOP = asyncio.new_event_loop()
+            _LOOP_THREAD = threading.Thread(target=_LOOP.run_forever, daemon=True)
+            _LOOP_THREAD.start()
+            asyncio.run_coroutine_threadsafe(_ROBOT.scraper.init(), _LOOP)
+    return _LOOP
+
+
+def submit_task(terms: List[str], task_id: str):
+    fut = asyncio.run_coroutine_threadsafe(_ROBOT.search(terms, task_id), _ensure_loop())
+    fut.add_done_callback(lambda f: _finish_task(task_id, f))
+
+
+def _finish_task(task_id: str, fut):
     try:
-        excel_path = asyncio.run(robot.search(terms, task_id))
-        results_store[task_id] = {"excel_path": str(excel_path), "status": "done"}
+        report = fut.result()
+        report["status"] = "done"
+        store_put(task_id, report)
     except Exception as e:
         log.exception("Robot failed")
-        results_store[task_id] = {"status": "failed", "reason": str(e)}
+        store_put(task_id, {"status": "failed", "reason": str(e)})
+    finally:
+        with _STORE_LOCK:
+            event = task_events.get(task_id)
+        if event:
+            event.set()
 
 
 INDEX_HTML = """
@@ -207,18 +339,24 @@ WAITING_HTML = """
 <p>لطفاً چند لحظه صبر کنید...</p>
 <script>
 let taskId = "{{ task_id }}";
-let checkInterval = setInterval(async () => {
-  let res = await fetch(`/api/status/${taskId}`);
-  let data = await res.json();
-  if (data.status === "done") {
-    clearInterval(checkInterval);
-    location.replace(`/result/${taskId}`);
-  }
-}, 2000);
+let source = new EventSource(`/api/events/${taskId}`);
+source.onmessage = () => {
+  source.close();
+  location.replace(`/result/${taskId}`);
+};
 </script>
 {% endblock %}
 """
 
+# Register the inline templates once so Jinja compiles them a single time
+# instead of re-parsing the source string on every request.
+app.jinja_loader = jinja2.ChoiceLoader([
+    jinja2.DictLoader({"base.html": INDEX_HTML, "result.html": RESULT_HTML, "waiting.html": WAITING_HTML}),
+    app.jinja_loader,
+])
+(BASE_DIR / "jinja_cache").mkdir(exist_ok=True)
+app.jinja_env.bytecode_cache = jinja2.FileSystemBytecodeCache(str(BASE_DIR / "jinja_cache"))
+
 
 @app.route("/", methods=["GET", "POST"])
 def index():
@@ -229,35 +367,55 @@ def index():
             return redirect(request.url)
         terms = [t.strip() for t in raw.split("\n") if t.strip()][:10]
         task_id = str(int(time.time()))
-        results_store[task_id] = {"status": "processing"}
-        threading.Thread(target=run_in_thread, args=(terms, task_id), daemon=True).start()
+        with _STORE_LOCK:
+            store_put(task_id, {"status": "processing"})
+            task_events[task_id] = threading.Event()
+        submit_task(terms, task_id)
         flash("جستجو شروع شد! نتیجه به‌زودی آماده می‌شود...", "info")
         return redirect(url_for("result", task_id=task_id))
-    return render_template_string(INDEX_HTML, sample_terms=DEFAULT_TERMS)
+    return render_template("base.html", sample_terms=DEFAULT_TERMS)
 
 
 @app.route("/result/<task_id>")
 def result(task_id):
-    if task_id not in results_store:
-        return render_template_string(WAITING_HTML, task_id=task_id)
-    report = results_store[task_id]
+    report = store_get(task_id)
+    if report is None or report.get("status") == "processing":
+        return render_template("waiting.html", task_id=task_id)
     if report.get("status") == "failed":
         return f"خطا: {report.get('reason')}", 500
-    return render_template_string(RESULT_HTML, report=report)
+    return render_template("result.html", report=report)
 
 
 @app.route("/api/status/<task_id>")
 def api_status(task_id):
-    if task_id not in results_store:
+    report = store_get(task_id)
+    if report is None:
         return jsonify({"status": "not_found"}), 404
-    return jsonify({"status": "done", "report": results_store[task_id]})
+    return jsonify({"status": "done", "report": report})
+
+
+@app.route("/api/events/<task_id>")
+def api_events(task_id):
+    with _STORE_LOCK:
+        event = task_events.get(task_id)
+    if event is None and store_get(task_id) is None:
+        return "Not found", 404
+
+    def stream():
+        while event and (store_get(task_id) or {}).get("status") == "processing":
+            if event.wait(30):
+                break
+            yield ": keep-alive\n\n"
+        yield "data: done\n\n"
+    return Response(stream(), mimetype="text/event-stream")
 
 
 @app.route("/api/download/<task_id>")
 def api_download(task_id):
-    if task_id not in results_store:
+    report = store_get(task_id)
+    if report is None:
         return "Not found", 404
-    path = results_store[task_id].get("excel_path")
+    path = report.get("excel_path")
     if path and pathlib.Path(path).exists():
         return send_file(path, as_attachment=True)
     return "File not ready", 202
@@ -266,7 +424,32 @@ def api_download(task_id):
 # ------------------------- CLI Entry -------------------------
 def cli_run():
     log.info("🚀 Starting Flask on http://localhost:5000")
-    app.run(host="0.0.0.0", port=5000, debug=False)
+    # One worker keeps results_store and the shared event-loop thread valid;
+    # the thread pool stops SSE streams and downloads blocking new submissions.
+    try:
+        from gunicorn.app.base import BaseApplication
+
+        class _App(BaseApplication):
+            def __init__(self, wsgi, options):
+                self._wsgi, self._options = wsgi, options
+                super().__init__()
+
+            def load_config(self):
+                for key, value in self._options.items():
+                    self.cfg.set(key, value)
+
+            def load(self):
+                return self._wsgi
+
+        _App(app, {"bind": "0.0.0.0:5000", "workers": 1, "threads": 8, "worker_class": "gthread"}).run()
+        return
+    except ImportError:
+        pass
+    try:
+        from waitress import serve
+        serve(app, host="0.0.0.0", port=5000, threads=8)
+    except ImportError:
+        app.run(host="0.0.0.0", port=5000, debug=False, threaded=True)
 
 if __name__ == "__main__":
     cli_run()